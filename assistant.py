@@ -1,16 +1,35 @@
+import asyncio
 import json
 import os
+import queue
+import re
 import readline
+import shlex
 import subprocess
-from typing import Dict, List, Optional
-
-import requests
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    AsyncIterator,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Tuple,
+)
+
+import httpx
 
 from memory import VectorMemory
 
 # 添加rich库导入
 try:
     from rich.console import Console
+    from rich.live import Live
     from rich.markdown import Markdown
     from rich.theme import Theme
 
@@ -20,6 +39,98 @@ except ImportError:
     print("警告: 未安装rich库，将使用普通文本输出", file=sys.stderr)
 
 
+# 允许执行的安全命令（模块级常量，避免每个实例重复构建）
+_SAFE_COMMANDS: FrozenSet[str] = frozenset(
+    sys.intern(cmd)
+    for cmd in (
+        "ls",
+        "pwd",
+        "echo",
+        "cat",
+        "grep",
+        "find",
+        "head",
+        "tail",
+        "wc",
+        "sort",
+        "uniq",
+        "diff",
+        "mkdir",
+        "rmdir",
+        "cp",
+        "mv",
+        "rm",
+        "touch",
+        "chmod",
+        "chown",
+        "date",
+        "cal",
+        "bc",
+        "man",
+        "which",
+        "whoami",
+        "id",
+        "ps",
+        "top",
+        "df",
+        "du",
+        "free",
+        "ping",
+        "curl",
+        "wget",
+        "git",
+        "tar",
+        "zip",
+        "unzip",
+        "gzip",
+    )
+)
+
+# Shell命令执行超时时间（秒）
+_COMMAND_TIMEOUT = 30
+
+# 启动时最多加载的命令历史条数 / 字节数
+_HISTORY_MAX_LINES = 2000
+_HISTORY_TAIL_BYTES = 256 * 1024
+
+# 流式渲染Markdown的刷新频率（次/秒）
+_LIVE_REFRESH_PER_SECOND = 10
+
+# 列表标记（"- "、"* "、"1. "、"2) "），提取键值事实时去除
+_LIST_MARKER_RE = re.compile(r"^\s*(?:[-*]|\d+[.)])\s+")
+
+# 每隔多少轮对摘要本身再压缩一次
+_SUMMARY_RECOMPRESS_TURNS = 100
+
+# 文件扩展名 -> 语言类型
+_EXT_MAP: Dict[str, str] = {
+    ".py": "Python",
+    ".js": "JavaScript",
+    ".ts": "TypeScript",
+    ".java": "Java",
+    ".cpp": "C++",
+    ".c": "C",
+    ".go": "Go",
+    ".rs": "Rust",
+    ".rb": "Ruby",
+    ".php": "PHP",
+    ".html": "HTML",
+    ".css": "CSS",
+    ".sql": "SQL",
+    ".md": "Markdown",
+    ".sh": "Shell",
+    ".json": "JSON",
+    ".xml": "XML",
+    ".yaml": "YAML",
+    ".yml": "YAML",
+    ".txt": "Text",
+    ".csv": "CSV",
+    ".ini": "INI",
+    ".cfg": "Config",
+    ".toml": "TOML",
+}
+
+
 class ShellAssistant:
     def __init__(
         self,
@@ -34,48 +145,6 @@ class ShellAssistant:
         self.history: List[Dict] = []
         self.max_history = max_history
         self.context_file = os.path.expanduser("~/.shell_assistant_context.json")
-        self.safe_commands = {
-            "ls",
-            "pwd",
-            "echo",
-            "cat",
-            "grep",
-            "find",
-            "head",
-            "tail",
-            "wc",
-            "sort",
-            "uniq",
-            "diff",
-            "mkdir",
-            "rmdir",
-            "cp",
-            "mv",
-            "rm",
-            "touch",
-            "chmod",
-            "chown",
-            "date",
-            "cal",
-            "bc",
-            "man",
-            "which",
-            "whoami",
-            "id",
-            "ps",
-            "top",
-            "df",
-            "du",
-            "free",
-            "ping",
-            "curl",
-            "wget",
-            "git",
-            "tar",
-            "zip",
-            "unzip",
-            "gzip",
-        }
         self.enable_vector_memory = enable_vector_memory
         if self.enable_vector_memory:
             self.vector_memory = VectorMemory()
@@ -97,10 +166,37 @@ class ShellAssistant:
             self.console = None
 
         self._load_context()
-        readline.parse_and_bind("tab: complete")
-        self.history_file = os.path.expanduser("~/.shell_assistant_history")
-        if os.path.exists(self.history_file):
-            readline.read_history_file(self.history_file)
+
+        # 滚动摘要：用一句话概括此前的对话，代替完整历史发送给LLM
+        self.summary: str = ""
+        self._summary_turns = 0
+        # 加载的代码文件消息：摘要无法覆盖，保留发送直到被 max_history 淘汰
+        self._loaded_messages: List[Dict] = []
+        # 长连接HTTP客户端与固定事件循环，避免每轮重新握手
+        self._loop = asyncio.new_event_loop()
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._http_client: Optional[httpx.Client] = None
+
+        # 后台LLM任务：摘要更新与键值提取各用一个线程，互不排队
+        self._summary_pool = ThreadPoolExecutor(max_workers=1)
+        self._kv_pool = ThreadPoolExecutor(max_workers=1)
+        # 尚未完成的摘要任务及其对应的对话消息（摘要完成前随请求一起发送）
+        self._summary_pending: List[Tuple[Future, List[Dict]]] = []
+        # 摘要代数：清空后递增，使过期的后台任务不再写回摘要
+        self._summary_gen = 0
+
+        # 后台线程异步写入对话上下文，避免阻塞响应
+        self._writer_q: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+
+        # 非交互输入（管道、脚本）时跳过readline
+        self._interactive = sys.stdin.isatty()
+        self._setup_readline_history()
+        # 命令历史延迟写入：标记脏数据，按间隔批量落盘
+        self._history_dirty = False
+        self._last_flush = 0.0
+        self._history_flush_interval = 2.0
 
     def _render_output(self, content: str):
         """渲染输出内容"""
@@ -126,27 +222,99 @@ class ShellAssistant:
             self.history = []
 
     def _save_context(self):
-        """保存对话上下文到文件"""
+        """保存对话上下文到文件（交给后台线程写入）"""
+        item = (self.context_file, list(self.history))
+        if self._writer_thread.is_alive():
+            self._writer_q.put(item)
+        else:
+            self._write_context_file(*item)
+
+    def _write_context_file(self, path: str, history: List[Dict]):
+        """原子写入对话上下文（先写临时文件再替换）"""
+        tmp_path = path + ".tmp"
         try:
-            with open(self.context_file, "w") as f:
-                json.dump(self.history, f)
+            with open(tmp_path, "w") as f:
+                json.dump(history, f)
+            os.replace(tmp_path, path)
         except IOError as e:
             print(f"Warning: Failed to save context - {str(e)}")
 
+    def _writer_loop(self):
+        """后台写入线程：合并积压的写请求，只写最新的一份"""
+        while True:
+            item = self._writer_q.get()
+            stop = item is None
+            # 丢弃过期的写请求，只保留最新一份
+            while not stop:
+                try:
+                    newer = self._writer_q.get_nowait()
+                except queue.Empty:
+                    break
+                if newer is None:
+                    stop = True
+                else:
+                    item = newer
+            if item is not None:
+                self._write_context_file(*item)
+            if stop:
+                return
+
+    def _close_context_writer(self):
+        """通知后台写入线程退出并等待剩余写入完成"""
+        if self._writer_thread.is_alive():
+            self._writer_q.put(None)
+            self._writer_thread.join()
+
     def _setup_readline_history(self):
         """设置命令历史记录文件"""
         self.history_file = os.path.expanduser("~/.shell_assistant_history")
-        if os.path.exists(self.history_file):
+        if not self._interactive:
+            return
+
+        readline.parse_and_bind("tab: complete")
+        # 先限制条数再读取，避免加载整个历史文件
+        readline.set_history_length(_HISTORY_MAX_LINES)
+        if not os.path.exists(self.history_file):
+            return
+
+        if os.path.getsize(self.history_file) <= _HISTORY_TAIL_BYTES:
             readline.read_history_file(self.history_file)
+            return
+
+        # 历史文件过大时只读取末尾部分
+        with open(self.history_file, "rb") as f:
+            f.seek(-_HISTORY_TAIL_BYTES, os.SEEK_END)
+            # 第一行可能被截断，丢弃
+            tail = f.read().decode("utf-8", "replace").splitlines()[1:]
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", suffix=".history", delete=False
+        ) as tmp:
+            tmp.write("\n".join(tail[-_HISTORY_MAX_LINES:]) + "\n")
+        try:
+            readline.read_history_file(tmp.name)
+        finally:
+            os.remove(tmp.name)
 
     def _save_history(self):
         """保存命令历史"""
+        if not self._interactive:
+            return
         readline.write_history_file(self.history_file)
+        self._history_dirty = False
+        self._last_flush = time.monotonic()
+
+    def _maybe_save_history(self):
+        """距上次写入超过间隔时才保存命令历史"""
+        if (
+            self._history_dirty
+            and time.monotonic() - self._last_flush > self._history_flush_interval
+        ):
+            self._save_history()
 
     def _is_safe_command(self, command: str) -> bool:
         """检查命令是否在安全命令列表中"""
-        cmd = command.strip().split()[0] if command.strip() else ""
-        return cmd in self.safe_commands
+        cmd = command.strip().partition(" ")[0]
+        return cmd in _SAFE_COMMANDS
 
     def execute_command(self, command: str) -> str:
         """执行Shell命令并返回输出"""
@@ -155,7 +323,7 @@ class ShellAssistant:
 
         try:
             if not self._is_safe_command(command):
-                return f"Error: Command '{command.split()[0]}' is not in the allowed list. For security reasons, I can only execute basic shell commands."
+                return f"Error: Command '{command.strip().partition(' ')[0]}' is not in the allowed list. For security reasons, I can only execute basic shell commands."
 
             if command.startswith("cd "):
                 try:
@@ -165,30 +333,63 @@ class ShellAssistant:
                 except Exception as e:
                     return f"Error changing directory: {str(e)}"
 
-            process = subprocess.Popen(
-                command,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+            # 直接执行参数列表，不经过 /bin/sh
+            result = subprocess.run(
+                shlex.split(command),
+                capture_output=True,
                 text=True,
+                timeout=_COMMAND_TIMEOUT,
             )
 
-            stdout, stderr = process.communicate()
-
-            if stderr:
-                return f"Error: {stderr.strip()}"
-            return stdout.strip()
+            if result.stderr:
+                return f"Error: {result.stderr.strip()}"
+            return result.stdout.strip()
+        except subprocess.TimeoutExpired:
+            return f"Error: Command timed out after {_COMMAND_TIMEOUT} seconds"
         except Exception as e:
             return f"Error executing command: {str(e)}"
 
-    def _stream_response(self, messages: List[Dict]) -> str:
-        """流式获取模型响应"""
-        headers = {
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """复用同一个异步HTTP/2客户端（连接在多轮对话间保持）"""
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                http2=True, timeout=httpx.Timeout(60.0, connect=10.0)
+            )
+        return self._async_client
+
+    def _get_http_client(self) -> httpx.Client:
+        """复用同一个同步HTTP/2客户端（供后台非流式请求使用）"""
+        if self._http_client is None:
+            self._http_client = httpx.Client(http2=True, timeout=30.0)
+        return self._http_client
+
+    def _close_http_clients(self):
+        """关闭HTTP客户端与事件循环"""
+        if self._async_client is not None:
+            self._loop.run_until_complete(self._async_client.aclose())
+            self._async_client = None
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+        self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        self._loop.close()
+
+    def _headers(self) -> Dict[str, str]:
+        """OpenRouter 请求的公共请求头"""
+        return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
             "HTTP-Referer": "https://localhost:3000",
             "X-Title": "Shell Assistant",
         }
+
+    async def _stream_response(self, messages: List[Dict]) -> AsyncIterator[str]:
+        """流式获取模型响应（httpx 异步 + HTTP/2，手动解析SSE）"""
+        headers = {
+            **self._headers(),
+            # 禁止压缩，避免代理按块缓冲导致首字延迟
+            "Accept-Encoding": "identity",
+        }
         payload = {
             "model": self.model,
             "messages": messages,
@@ -197,69 +398,197 @@ class ShellAssistant:
         }
 
         try:
-            full_response = ""
-            with requests.post(
-                self.base_url, headers=headers, json=payload, stream=True
+            client = self._get_async_client()
+            async with client.stream(
+                "POST", self.base_url, headers=headers, json=payload
             ) as response:
                 response.raise_for_status()
 
-                for chunk in response.iter_lines():
-                    if chunk:
-                        chunk_str = chunk.decode("utf-8")
-                        if chunk_str.startswith("data: "):
-                            data = chunk_str[6:]
+                buffer = b""
+                async for raw in response.aiter_raw():
+                    # 在累计缓冲区上统一换行，避免 \r\n 被拆在两次读取之间
+                    buffer = (buffer + raw).replace(b"\r\n", b"\n")
+                    # SSE 事件以空行分隔
+                    while b"\n\n" in buffer:
+                        event_bytes, buffer = buffer.split(b"\n\n", 1)
+                        for line in event_bytes.decode("utf-8").split("\n"):
+                            if not line.startswith("data: "):
+                                continue
+                            data = line[6:]
                             if data == "[DONE]":
-                                break
+                                return
                             try:
                                 event = json.loads(data)
-                                if "choices" in event and len(event["choices"]) > 0:
-                                    delta = event["choices"][0].get("delta", {})
-                                    content = delta.get("content", "")
-                                    if content:
-                                        full_response += content
-                                        yield content
                             except json.JSONDecodeError:
-                                pass
-                return full_response
-        except requests.exceptions.RequestException as e:
+                                continue
+                            if "choices" in event and len(event["choices"]) > 0:
+                                delta = event["choices"][0].get("delta", {})
+                                content = delta.get("content", "")
+                                if content:
+                                    yield content
+        except httpx.HTTPError as e:
             yield f"\nError communicating with API: {str(e)}"
-            return f"Error communicating with API: {str(e)}"
+
+    async def _collect_response(
+        self, messages: List[Dict], on_chunk: Callable[[str, str], None]
+    ) -> str:
+        """消费流式响应，每收到一块调用 on_chunk(chunk, 已累计内容)"""
+        full_response = ""
+        async for chunk in self._stream_response(messages):
+            full_response += chunk
+            on_chunk(chunk, full_response)
+        return full_response
+
+    def _run_response(
+        self, messages: List[Dict], on_chunk: Callable[[str, str], None]
+    ) -> str:
+        """在常驻事件循环中获取流式响应，被中断时取消未完成的任务"""
+        task = self._loop.create_task(self._collect_response(messages, on_chunk))
+        try:
+            return self._loop.run_until_complete(task)
+        except BaseException:
+            # 如 Ctrl-C：取消旧的流，避免下一轮时继续输出
+            task.cancel()
+            self._loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            raise
+
+    def _summarize(
+        self, prev_summary: str, prompt: Optional[str], response: Optional[str]
+    ) -> str:
+        """调用LLM（非流式）生成新的一句话摘要，失败时保留旧摘要
+
+        prompt 为 None 时只压缩已有摘要
+        """
+        if prompt is None:
+            instruction = (
+                f"Summary: {prev_summary}\n"
+                "Compress this summary into one sentence."
+            )
+        else:
+            instruction = (
+                f"Previous summary: {prev_summary}\n"
+                f"New turn: user={prompt[:2000]}\n"
+                f"assistant={response[:2000]}\n"
+                "Return one sentence."
+            )
+
+        return self._complete(instruction, max_tokens=60) or prev_summary
+
+    def _complete(self, instruction: str, max_tokens: int) -> str:
+        """非流式调用LLM，失败时返回空字符串"""
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": instruction}],
+            "max_tokens": max_tokens,
+        }
+
+        try:
+            response = self._get_http_client().post(
+                self.base_url, headers=self._headers(), json=payload
+            )
+            response.raise_for_status()
+            content = response.json()["choices"][0]["message"]["content"]
+            return (content or "").strip()
+        except (httpx.HTTPError, KeyError, IndexError, ValueError):
+            return ""
+
+    def _extract_kv_facts(self, prompt: str, response: str) -> List[str]:
+        """从一轮对话中提取 3-5 条 key: value 事实"""
+        turn = f"user: {prompt[:2000]}\nassistant: {response[:2000]}"
+        content = self._complete(
+            "Extract 3-5 key:value facts from the following conversation turn. "
+            "Reply with one `key: value` per line and nothing else.\n\n" + turn,
+            max_tokens=120,
+        )
+
+        facts = []
+        for line in content.splitlines():
+            line = _LIST_MARKER_RE.sub("", line).strip()
+            key, sep, value = line.partition(":")
+            if sep and key.strip() and value.strip():
+                facts.append(f"{key.strip()}: {value.strip()}")
+        return facts[:5]
+
+    def _store_kv_facts(self, turn_id: str, prompt: str, response: str):
+        """后台任务：提取键值事实并作为检索锚点存入向量记忆"""
+        facts = self._extract_kv_facts(prompt, response)
+        if facts:
+            self.vector_memory.store_memories_batch_async(
+                [
+                    {
+                        "role": "assistant",
+                        "content": fact,
+                        "metadata": {"type": "kv", "parent_id": turn_id},
+                    }
+                    for fact in facts
+                ]
+            )
+
+    def _update_summary(self, gen: int, turn: int, prompt: str, response: str):
+        """后台任务：合并新一轮对话到摘要，定期压缩摘要本身
+
+        摘要任务在单线程中按顺序执行，直接写回 self.summary；
+        清空后（代数变化）的过期任务不写回。失败时保留旧摘要。
+        """
+        try:
+            summary = self._summarize(self.summary, prompt, response)
+            if turn % _SUMMARY_RECOMPRESS_TURNS == 0:
+                summary = self._summarize(summary, None, None)
+        except Exception as e:
+            print(f"[Warning] Failed to update summary - {str(e)}")
+            return
+        if gen == self._summary_gen:
+            self.summary = summary
+
+    def _pending_summary_messages(self) -> List[Dict]:
+        """丢弃已完成的摘要任务，返回仍未被摘要覆盖的对话消息（不等待）"""
+        self._summary_pending = [
+            (future, turn)
+            for future, turn in self._summary_pending
+            if not future.done()
+        ]
+        return [msg for _, turn in self._summary_pending for msg in turn]
+
+    def _reset_summary(self):
+        """清空摘要与待摘要消息"""
+        self._summary_gen += 1
+        self.summary = ""
+        self._summary_turns = 0
+        self._summary_pending = []
+        self._loaded_messages = []
+
+    def _build_messages(self, enhanced_prompt: str) -> List[Dict]:
+        """构建发送给LLM的消息：摘要 + 仍在历史中的代码文件
+        + 摘要尚未覆盖的最近对话 + 当前问题
+
+        不等待后台摘要任务，避免拖慢首字响应
+        """
+        current = {"role": "user", "content": enhanced_prompt}
+        pending = self._pending_summary_messages()
+        if not self.summary:
+            # 尚无摘要（如刚启动），使用修剪后的历史
+            return self.history + [current]
+        return (
+            [{"role": "system", "content": f"此前对话摘要: {self.summary}"}]
+            + self._loaded_messages
+            + pending
+            + [current]
+        )
 
     def _trim_history(self):
         """修剪历史记录，确保不超过最大限制"""
         if len(self.history) > self.max_history * 2:
             self.history = self.history[-self.max_history * 2 :]
-
-    def _detect_language(self, filename: str) -> str:
+            # 同步淘汰已移出历史的代码文件消息
+            alive = {id(msg) for msg in self.history}
+            self._loaded_messages = [
+                msg for msg in self._loaded_messages if id(msg) in alive
+            ]
+
+    @staticmethod
+    def _detect_language(filename: str) -> str:
         """根据文件扩展名推测语言类型"""
-        ext_map = {
-            ".py": "Python",
-            ".js": "JavaScript",
-            ".ts": "TypeScript",
-            ".java": "Java",
-            ".cpp": "C++",
-            ".c": "C",
-            ".go": "Go",
-            ".rs": "Rust",
-            ".rb": "Ruby",
-            ".php": "PHP",
-            ".html": "HTML",
-            ".css": "CSS",
-            ".sql": "SQL",
-            ".md": "Markdown",
-            ".sh": "Shell",
-            ".json": "JSON",
-            ".xml": "XML",
-            ".yaml": "YAML",
-            ".yml": "YAML",
-            ".txt": "Text",
-            ".csv": "CSV",
-            ".ini": "INI",
-            ".cfg": "Config",
-            ".toml": "TOML",
-        }
-        _, ext = os.path.splitext(filename)
-        return ext_map.get(ext.lower(), "Unknown")
+        return _EXT_MAP.get(os.path.splitext(filename)[1].lower(), "Unknown")
 
     def _load_code_file(self, file_path: str):
         """加载代码文件时也存入向量记忆"""
@@ -268,8 +597,8 @@ class ShellAssistant:
             return
 
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                code_content = f.read()
+            with open(file_path, "rb", buffering=1 << 16) as f:
+                code_content = f.read().decode("utf-8", "replace")
 
             language = self._detect_language(file_path)
 
@@ -280,7 +609,9 @@ class ShellAssistant:
                 "```"
             )
 
-            self.history.append({"role": "user", "content": message})
+            loaded = {"role": "user", "content": message}
+            self.history.append(loaded)
+            self._loaded_messages.append(loaded)
 
             # 存入向量记忆
             if self.enable_vector_memory:
@@ -295,9 +626,10 @@ class ShellAssistant:
             self._trim_history()
             self._save_context()
 
-            lines = code_content.split("\n")[:10]
-            preview = "\n".join(lines)
-            if len(code_content.split("\n")) > 10:
+            # 最多切分10次，不必拆分整个文件
+            lines = code_content.split("\n", 10)
+            preview = "\n".join(lines[:10])
+            if len(lines) > 10:
                 preview += "\n..."
             print(f"[Info] Loaded file '{file_path}' ({language}) into context.")
             print(f"\nPreview of loaded code:\n{preview}\n")
@@ -319,6 +651,7 @@ class ShellAssistant:
 
         self.vector_memory.clear_memory()
         self.history = []
+        self._reset_summary()
         print("[Info] All memories and conversation history cleared")
 
     def chat(self, prompt: str, execute_shell: bool = False) -> str:
@@ -327,28 +660,26 @@ class ShellAssistant:
         # 1. 检索相关记忆
         relevant_memories = []
         if self.enable_vector_memory and len(prompt) > 10:
-            relevant_memories = self.vector_memory.search_relevant_memories(
+            relevant_memories = self.vector_memory.search_memories_by_kv(
                 prompt, top_k=3
             )
 
         # 2. 构建增强的prompt
-        context = ""
-        if relevant_memories:
-            context = (
-                "相关历史对话:\n"
-                + "\n".join(
-                    [
-                        f"- {mem['metadata']['role']}: {mem['content'][:150]}..."
-                        for mem in relevant_memories
-                    ]
-                )
-                + "\n\n"
-            )
+        parts = []
+        for mem in relevant_memories:
+            content = mem["content"]
+            # 只有确实截断时才加省略号
+            if len(content) > 150:
+                content = content[:150] + "..."
+            parts.append(f"- {mem['metadata']['role']}: {content}")
+        context = "相关历史对话:\n" + "\n".join(parts) + "\n\n" if parts else ""
 
         enhanced_prompt = context + f"当前问题: {prompt}"
 
-        # 3. 调用LLM（使用增强后的prompt）
-        self.history.append({"role": "user", "content": enhanced_prompt})
+        # 3. 调用LLM（使用摘要 + 增强后的prompt）
+        messages = self._build_messages(enhanced_prompt)
+        user_message = {"role": "user", "content": enhanced_prompt}
+        self.history.append(user_message)
 
         response = ""
         # print("Assistant: ", end="", flush=True)
@@ -356,34 +687,74 @@ class ShellAssistant:
         # 4. 流式获取响应
         full_response = ""
         print("Assistant: ", end="", flush=True)
-        for chunk in self._stream_response(self.history):
-            full_response += chunk
-            print(chunk, end="", flush=True)
-        print()
-        if RICH_AVAILABLE and self.console:
-            try:
-                self.console.print(Markdown(full_response))
-            except Exception as e:
-                print(f"Markdown rendering failed: {e}")
-                pass
+        use_rich = RICH_AVAILABLE and self.console
+        if use_rich and sys.stdout.isatty():
+            print()
+            # 边接收边渲染Markdown，按刷新间隔节流，避免每块都重新解析全文
+            last_render = 0.0
+
+            def render(chunk: str, text: str):
+                nonlocal last_render
+                now = time.monotonic()
+                if now - last_render >= 1 / _LIVE_REFRESH_PER_SECOND:
+                    live.update(Markdown(text))
+                    last_render = now
+
+            with Live(
+                Markdown(""),
+                console=self.console,
+                refresh_per_second=_LIVE_REFRESH_PER_SECOND,
+            ) as live:
+                full_response = self._run_response(messages, render)
+                live.update(Markdown(full_response))
+        else:
+            # 输出不是终端（管道、重定向）时不使用Live，避免写入光标控制帧
+            full_response = self._run_response(
+                messages, lambda chunk, text: print(chunk, end="", flush=True)
+            )
+            print()
+            if use_rich:
+                self._render_output(full_response)
 
         # 5. 存储到向量记忆
         if self.enable_vector_memory:
-            # 存储用户问题
-            self.vector_memory.store_memory(
-                role="user", content=prompt, metadata={"type": "query"}
-            )
-
-            # 存储AI回答
-            self.vector_memory.store_memory(
-                role="assistant", content=full_response, metadata={"type": "response"}
+            # 用户问题与AI回答合并为一次批量写入，在后台线程完成
+            turn_id = str(uuid.uuid4())
+            self.vector_memory.store_memories_batch_async(
+                [
+                    {
+                        "role": "user",
+                        "content": prompt,
+                        "metadata": {"type": "query", "turn_id": turn_id},
+                    },
+                    {
+                        "role": "assistant",
+                        "content": full_response,
+                        "metadata": {"type": "response", "turn_id": turn_id},
+                    },
+                ]
             )
 
-        # 6. 更新对话历史
+        # 6. 更新对话历史，并在后台更新滚动摘要
         if full_response:
-            self.history.append({"role": "assistant", "content": full_response})
+            assistant_message = {"role": "assistant", "content": full_response}
+            self.history.append(assistant_message)
             self._trim_history()
             self._save_context()
+            self._summary_turns += 1
+            future = self._summary_pool.submit(
+                self._update_summary,
+                self._summary_gen,
+                self._summary_turns,
+                prompt,
+                full_response,
+            )
+            self._summary_pending.append((future, [user_message, assistant_message]))
+            # 提取键值事实作为检索锚点
+            if self.enable_vector_memory:
+                self._kv_pool.submit(
+                    self._store_kv_facts, turn_id, prompt, full_response
+                )
 
         return full_response
 
@@ -405,8 +776,15 @@ class ShellAssistant:
         try:
             while True:
                 try:
-                    user_input = input("You: ").strip()
-                    self._save_history()
+                    if self._interactive:
+                        user_input = input("You: ").strip()
+                        self._history_dirty = True
+                        self._maybe_save_history()
+                    else:
+                        line = sys.stdin.readline()
+                        if not line:
+                            break
+                        user_input = line.strip()
 
                     if not user_input:
                         continue
@@ -417,6 +795,7 @@ class ShellAssistant:
 
                     if user_input.lower() == "/clear":
                         self.history = []
+                        self._reset_summary()
                         print("\n对话历史已清除\n")
                         self._save_context()
                         continue
@@ -444,3 +823,12 @@ class ShellAssistant:
         finally:
             self._save_history()
             self._save_context()
+            self._close_context_writer()
+            # 摘要不持久化，退出时直接取消；关闭HTTP客户端会中止进行中的请求
+            self._summary_gen += 1
+            self._summary_pool.shutdown(wait=False, cancel_futures=True)
+            # 先等键值提取提交完写入，再等待写入完成
+            self._kv_pool.shutdown(wait=True)
+            if self.enable_vector_memory:
+                self.vector_memory.flush()
+            self._close_http_clients()
@@ -1,13 +1,65 @@
+import hashlib
+import heapq
 import json
 import os
+import threading
+import time
 import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
+import numpy as np
 from chromadb import PersistentClient
-from openai import OpenAI
 from typing_extensions import NoDefault
 
+# 向量在存储前已归一化，使用内积距离
+_HNSW_SPACE = "ip"
+
+# 本地嵌入模型（bge-small-zh-v1.5 的 ONNX 导出，中文为主，兼顾英文）
+_EMBEDDING_MODEL = "Xenova/bge-small-zh-v1.5"
+_EMBEDDING_MAX_TOKENS = 512
+
+
+class _LocalEmbedder:
+    """基于 onnxruntime 的本地 BGE 嵌入模型（CLS pooling）"""
+
+    def __init__(self, repo_id: str, max_length: int):
+        import onnxruntime
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        # 首次使用时下载并缓存到本地
+        model_path = hf_hub_download(repo_id, "onnx/model.onnx")
+        tokenizer_path = hf_hub_download(repo_id, "tokenizer.json")
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        pad_id = self.tokenizer.token_to_id("[PAD]") or 0
+        self.tokenizer.enable_padding(pad_id=pad_id, pad_token="[PAD]")
+
+        self.session = onnxruntime.InferenceSession(
+            model_path, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        feeds = {
+            "input_ids": input_ids,
+            "attention_mask": np.array(
+                [e.attention_mask for e in encodings], dtype=np.int64
+            ),
+        }
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+
+        # BGE 取 [CLS] 位置的隐藏状态作为句向量
+        hidden = self.session.run(None, feeds)[0]
+        return hidden[:, 0]
+
 
 class VectorMemory:
     def __init__(
@@ -22,33 +74,110 @@ class VectorMemory:
         # 创建 ChromaDB 客户端
         self.client = PersistentClient(path=persist_path)
 
-        try:
-            self.client.delete_collection(name=collection_name)
-            print("[INFO]已删除旧collection,重建新维度")
-        except:
-            pass
+        # 嵌入向量 LRU 缓存（key 为内容哈希，value 为 FP16 向量）
+        self._emb_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._emb_cache_max = 512
+
+        # 本地 ONNX 嵌入模型（延迟加载）
+        self._embedding_fn = None
+
+        # 后台写入线程（单线程，保证写入顺序），缓存与模型加载需加锁
+        self._emb_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._pending: List[Future] = []
+        self._pending_lock = threading.Lock()
 
         # 获取或创建 collection
         self.collection = self.client.get_or_create_collection(
             name=collection_name,
-            metadata={"hnsw:space": "cosine"},  # 使用余弦相似度
+            # 向量已归一化，内积即余弦相似度，省去距离计算中的除法
+            metadata={"hnsw:space": _HNSW_SPACE},
         )
 
+        # 嵌入维度记录文件（避免每次启动都加载模型探测维度）
+        self._emb_dim_file = os.path.join(os.path.dirname(persist_path), "emb_dim")
+
+        # 仅在向量维度不一致时重建 collection
+        self._check_embedding_dim()
+
         # 检查是否需要迁移数据（从旧格式迁移）
         self._migrate_if_needed()
 
+        # 按角色/类型计数，存储时增量更新，统计时无需全量扫描
+        self._role_counts: Counter = Counter()
+        self._type_counts: Counter = Counter()
+        self._kv_count = 0
+        self._count_memories(self.collection.get(include=["metadatas"])["metadatas"])
+
+    def _count_memories(self, metadatas: List[Dict[str, Any]]):
+        """将新增记忆计入角色/类型统计（键值事实单独计数）"""
+        for meta in metadatas:
+            if meta.get("type") == "kv":
+                self._kv_count += 1
+                continue
+            self._role_counts[meta.get("role", "unknown")] += 1
+            self._type_counts[meta.get("type", "unknown")] += 1
+
+    def _expected_embedding_dim(self) -> int:
+        """获取当前嵌入模型的向量维度（结果缓存到文件，格式为 "模型名:维度"）"""
+        try:
+            with open(self._emb_dim_file, "r") as f:
+                model, _, dim = f.read().strip().rpartition(":")
+            # 模型已更换时缓存失效，重新探测
+            if model == _EMBEDDING_MODEL:
+                return int(dim)
+        except (IOError, ValueError):
+            pass
+
+        dim = len(self._get_embedding("probe"))
+        try:
+            with open(self._emb_dim_file, "w") as f:
+                f.write(f"{_EMBEDDING_MODEL}:{dim}")
+        except IOError as e:
+            print(f"[Warning] Failed to save embedding dim - {str(e)}")
+        return dim
+
+    def _check_embedding_dim(self):
+        """检查已有向量维度，与当前模型不一致时才重建 collection"""
+        peek = self.collection.peek(1)
+        embeddings = peek.get("embeddings")
+        if embeddings is None or len(embeddings) == 0:
+            return
+
+        stored_dim = len(embeddings[0])
+        expected_dim = self._expected_embedding_dim()
+        if stored_dim == expected_dim:
+            return
+
+        print(
+            f"[Info] Embedding dim changed ({stored_dim} -> {expected_dim}), "
+            "rebuilding collection"
+        )
+        self.client.delete_collection(self.collection.name)
+        self.collection = self.client.create_collection(
+            name=self.collection.name, metadata={"hnsw:space": _HNSW_SPACE}
+        )
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        """按行 L2 归一化，使内积等于余弦相似度"""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
+        return embeddings
+
     def _migrate_if_needed(self):
         """迁移旧格式数据"""
-        # 检查是否已存在数据
-        docs = self.collection.get()
-        if not docs["documents"]:
+        # 只取第一条记录检查格式，避免启动时全量读取
+        first = self.collection.get(limit=1, include=["documents"])
+        if not first["documents"]:
             return
 
         # 检查第一条记录的格式
-        first_doc = docs["documents"][0]
+        first_doc = first["documents"][0]
         if isinstance(first_doc, str) and first_doc.startswith("{"):
             # 旧格式（JSON字符串），需要迁移
             print("[Info] Migrating old memory format...")
+            docs = self.collection.get()
             new_docs = []
             new_metadatas = []
             new_ids = []
@@ -63,7 +192,7 @@ class VectorMemory:
             # 清空原有数据
             self.client.delete_collection(self.collection.name)
             self.collection = self.client.create_collection(
-                name=self.collection.name, metadata={"hnsw:space": "cosine"}
+                name=self.collection.name, metadata={"hnsw:space": _HNSW_SPACE}
             )
 
             # 重新添加数据
@@ -73,30 +202,60 @@ class VectorMemory:
             print("[Info] Migration completed")
 
     def _get_embedding(self, text: str) -> List[float]:
-        """获取文本的嵌入向量（使用 OpenRouter 的 embeddings API）"""
-        import os
-
-        from openai import OpenAI
-
-        api_key = os.getenv("DASHSCOPE_API_KEY")  # 复用你的 OpenRouter key
-        if not api_key:
-            raise Exception("DASHSCOPE_API_KEY 未设置，请检查环境变量")
-
-        client = OpenAI(
-            api_key=api_key,
-            base_url="https://openrouter.ai/api/v1",
-        )
+        """获取文本的嵌入向量（使用本地 ONNX 模型）"""
+        return self._get_embeddings([text])[0]
+
+    @staticmethod
+    def _emb_cache_key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """批量获取嵌入向量，命中缓存的文本不再重复计算
+
+        向量统一量化为 FP16 后缓存和存储，内存占用约为 FP32 的一半
+        """
+        keys = [self._emb_cache_key(t) for t in texts]
+        results: List[Optional[np.ndarray]] = [None] * len(texts)
+        missing: Dict[bytes, str] = {}
+
+        with self._emb_lock:
+            for i, key in enumerate(keys):
+                cached = self._emb_cache.get(key)
+                if cached is not None:
+                    self._emb_cache.move_to_end(key)
+                    results[i] = cached
+                else:
+                    missing.setdefault(key, texts[i])
+
+        if missing:
+            fetched = self._fetch_embeddings(list(missing.values()))
+            with self._emb_lock:
+                for key, embedding in zip(missing.keys(), fetched):
+                    self._emb_cache[key] = embedding
+                    if len(self._emb_cache) > self._emb_cache_max:
+                        self._emb_cache.popitem(last=False)
+            lookup = dict(zip(missing.keys(), fetched))
+            for i, key in enumerate(keys):
+                if results[i] is None:
+                    results[i] = lookup[key]
+
+        return [emb.tolist() for emb in results]
+
+    def _fetch_embeddings(self, texts: List[str]) -> np.ndarray:
+        """使用本地 ONNX 模型批量计算嵌入向量（模型缓存后无需网络请求）"""
+        with self._emb_lock:
+            if self._embedding_fn is None:
+                # 延迟加载：首次使用时才下载并加载模型（在锁内完成）
+                self._embedding_fn = _LocalEmbedder(
+                    _EMBEDDING_MODEL, _EMBEDDING_MAX_TOKENS
+                )
 
         try:
-            response = client.embeddings.create(
-                model="baai/bge-m3",  # 可改成想用的模型
-                input=text,
-                encoding_format="float",  # 默认返回 float 向量
-            )
-            # 返回第一个（也是唯一一个）embedding
-            return response.data[0].embedding
+            # 统一归一化后再量化
+            embeddings = self._embedding_fn(texts)
+            return self._normalize(embeddings).astype(np.float16)
         except Exception as e:
-            raise Exception(f"OpenRouter embedding failed: {str(e)}")
+            raise Exception(f"Local embedding failed: {str(e)}")
 
     def store_memory(
         self, role: str, content: str, metadata: Optional[Dict[str, Any]] = None
@@ -109,6 +268,7 @@ class VectorMemory:
         meta = {
             "role": role,
             "timestamp": datetime.now().isoformat(),
+            "ts_ns": time.time_ns(),
             "type": "text",  # 默认类型
             **(metadata or {}),
         }
@@ -123,9 +283,62 @@ class VectorMemory:
             metadatas=[meta],
             ids=[memory_id],
         )
+        self._count_memories([meta])
 
         return memory_id
 
+    def store_memories_batch(self, items: List[Dict[str, Any]]) -> List[str]:
+        """批量存储多条记忆（一次 embedding 请求 + 一次写入）
+
+        items 中每一项为 {"role": ..., "content": ..., "metadata": {...}}
+        """
+        if not items:
+            return []
+
+        memory_ids = [str(uuid.uuid4()) for _ in items]
+        documents = [item["content"] for item in items]
+        metadatas = [
+            {
+                "role": item["role"],
+                "timestamp": datetime.now().isoformat(),
+                "ts_ns": time.time_ns(),
+                "type": "text",  # 默认类型
+                **(item.get("metadata") or {}),
+            }
+            for item in items
+        ]
+
+        # 一次性获取所有嵌入向量
+        embeddings = self._get_embeddings(documents)
+
+        # 存储到 ChromaDB
+        self.collection.add(
+            embeddings=embeddings,
+            documents=documents,
+            metadatas=metadatas,
+            ids=memory_ids,
+        )
+        self._count_memories(metadatas)
+
+        return memory_ids
+
+    def store_memories_batch_async(self, items: List[Dict[str, Any]]) -> Future:
+        """在后台线程中批量存储记忆，立即返回 Future"""
+        future = self._pool.submit(self.store_memories_batch, items)
+        with self._pending_lock:
+            self._pending = [f for f in self._pending if not f.done()]
+            self._pending.append(future)
+        return future
+
+    def flush(self):
+        """等待所有后台写入完成"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        wait(pending)
+        for future in pending:
+            if future.exception() is not None:
+                print(f"[Warning] Failed to store memory - {future.exception()}")
+
     def store_code_memory(
         self,
         role: str,
@@ -145,6 +358,7 @@ class VectorMemory:
         meta = {
             "role": role,
             "timestamp": datetime.now().isoformat(),
+            "ts_ns": time.time_ns(),
             "type": "code",
             "file_path": file_path,
             "language": language,
@@ -162,35 +376,53 @@ class VectorMemory:
             metadatas=[meta],
             ids=[memory_id],
         )
+        self._count_memories([meta])
 
         return memory_id
 
+    @staticmethod
+    def _build_where(
+        filter_role: Optional[str] = None,
+        filter_type: Optional[str] = None,
+        extra: Optional[List[Dict[str, Any]]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """构建 ChromaDB where 条件，多个条件时使用 $and 组合"""
+        conds: List[Dict[str, Any]] = []
+        if filter_role:
+            conds.append({"role": filter_role})
+        if filter_type:
+            conds.append({"type": filter_type})
+        conds.extend(extra or [])
+
+        if not conds:
+            return None
+        return conds[0] if len(conds) == 1 else {"$and": conds}
+
     def search_relevant_memories(
         self,
         query: str,
         top_k: int = 3,
         filter_role: Optional[str] = None,
         filter_type: Optional[str] = None,
+        exclude_type: Optional[str] = None,
     ) -> List[Dict]:
         """搜索与查询最相关的记忆"""
         # 获取查询向量
         query_embedding = self._get_embedding(query)
 
         # 构建查询条件
-        where_clause = None
-        if filter_role or filter_type:
-            where_clause = {}
-            if filter_role:
-                where_clause["role"] = filter_role
-            if filter_type:
-                where_clause["type"] = filter_type
+        query_kwargs: Dict[str, Any] = {}
+        extra = [{"type": {"$ne": exclude_type}}] if exclude_type else []
+        where = self._build_where(filter_role, filter_type, extra)
+        if where is not None:
+            query_kwargs["where"] = where
 
         # 执行查询
         results = self.collection.query(
             query_embeddings=[query_embedding],
             n_results=top_k,
-            where=where_clause,
             include=["documents", "metadatas", "distances"],
+            **query_kwargs,
         )
 
         # 格式化结果
@@ -199,74 +431,116 @@ class VectorMemory:
             for i, doc in enumerate(results["documents"][0]):
                 memories.append(
                     {
+                        "id": results["ids"][0][i],
                         "content": doc,
                         "metadata": results["metadatas"][0][i],
                         "distance": results["distances"][0][i],
                         "relevance_score": 1
-                        - results["distances"][0][i],  # 余弦相似度越小越相关
+                        - results["distances"][0][i],  # 内积距离越小越相关
                     }
                 )
 
         return memories
 
+    def search_memories_by_kv(self, query: str, top_k: int = 3) -> List[Dict]:
+        """先在键值事实（type=kv）中检索并取回对应的完整对话，
+        再与排除键值事实的普通检索结果合并（按ID去重，最多 top_k 条）
+        """
+        kv_hits = self.search_relevant_memories(query, top_k=top_k, filter_type="kv")
+
+        # 按相关度记录每个对话的最佳距离
+        parent_distance: Dict[str, float] = {}
+        for hit in kv_hits:
+            parent_id = hit["metadata"].get("parent_id")
+            if parent_id and parent_id not in parent_distance:
+                parent_distance[parent_id] = hit["distance"]
+
+        memories = []
+        if parent_distance:
+            docs = self.collection.get(
+                where={"turn_id": {"$in": list(parent_distance)}},
+                include=["documents", "metadatas"],
+            )
+            for memory_id, doc, meta in zip(
+                docs["ids"], docs["documents"], docs["metadatas"]
+            ):
+                distance = parent_distance[meta["turn_id"]]
+                memories.append(
+                    {
+                        "id": memory_id,
+                        "content": doc,
+                        "metadata": meta,
+                        "distance": distance,
+                        "relevance_score": 1 - distance,
+                    }
+                )
+
+        # 普通检索兜底：覆盖代码记忆、旧数据以及父记录缺失的情况
+        memories.extend(
+            self.search_relevant_memories(query, top_k=top_k, exclude_type="kv")
+        )
+        memories.sort(key=lambda x: (x["distance"], x["metadata"].get("ts_ns", 0)))
+
+        seen = set()
+        merged = []
+        for memory in memories:
+            if memory["id"] in seen:
+                continue
+            seen.add(memory["id"])
+            merged.append(memory)
+            if len(merged) >= top_k:
+                break
+
+        return merged
+
     def get_recent_memories(
         self,
         limit: int = 10,
         filter_role: Optional[str] = None,
         filter_type: Optional[str] = None,
+        since_ns: Optional[int] = None,
     ) -> List[Dict]:
         """获取最近的历史记录（按时间）"""
-        # ChromaDB 本身不支持按时间排序，需要手动处理
-        all_docs = self.collection.get(include=["documents", "metadatas"])
-
-        # 过滤和排序
-        filtered = []
-        for i, doc in enumerate(all_docs["documents"]):
-            meta = all_docs["metadatas"][i]
-
-            # 过滤条件
-            if filter_role and meta.get("role") != filter_role:
-                continue
-            if filter_type and meta.get("type") != filter_type:
-                continue
-
-            filtered.append(
-                {
-                    "content": doc,
-                    "metadata": meta,
-                    "timestamp": meta.get("timestamp", ""),
-                }
-            )
-
-        # 按时间戳排序（最新的在前）
-        sorted_memories = sorted(filtered, key=lambda x: x["timestamp"], reverse=True)
+        # 过滤条件下推到 ChromaDB
+        extra = [{"ts_ns": {"$gt": since_ns}}] if since_ns is not None else []
+        where = self._build_where(filter_role, filter_type, extra)
+
+        docs = self.collection.get(where=where, include=["documents", "metadatas"])
+
+        memories = (
+            {
+                "content": doc,
+                "metadata": meta,
+                "timestamp": meta.get("timestamp", ""),
+            }
+            for doc, meta in zip(docs["documents"], docs["metadatas"])
+        )
 
-        return sorted_memories[:limit]
+        # ChromaDB 本身不支持按时间排序，用堆只取最新的 limit 条
+        # （旧数据没有 ts_ns，退回按时间戳字符串比较）
+        return heapq.nlargest(
+            limit,
+            memories,
+            key=lambda x: (x["metadata"].get("ts_ns", 0), x["timestamp"]),
+        )
 
     def clear_memory(self):
         """清空所有记忆"""
+        self.flush()
         self.client.delete_collection(self.collection.name)
         self.collection = self.client.create_collection(
-            name=self.collection.name, metadata={"hnsw:space": "cosine"}
+            name=self.collection.name, metadata={"hnsw:space": _HNSW_SPACE}
         )
+        self._role_counts.clear()
+        self._type_counts.clear()
+        self._kv_count = 0
         print("[Info] All memories cleared")
 
     def get_memory_stats(self) -> Dict:
         """获取记忆库统计信息"""
-        docs = self.collection.get()
-        stats = {
-            "total_memories": len(docs["documents"]),
-            "memories_by_role": {},
-            "memories_by_type": {},
+        return {
+            "total_memories": sum(self._role_counts.values()),
+            "memories_by_role": dict(self._role_counts),
+            "memories_by_type": dict(self._type_counts),
+            "kv_facts": self._kv_count,
         }
-
-        for meta in docs["metadatas"]:
-            role = meta.get("role", "unknown")
-            mem_type = meta.get("type", "unknown")
-
-            stats["memories_by_role"][role] = stats["memories_by_role"].get(role, 0) + 1
-            stats["memories_by_type"][mem_type] = (
-                stats["memories_by_type"].get(mem_type, 0) + 1
-            )
-
-        return stats